@@ -1,13 +1,21 @@
 """Environments + agents for 2-armed bandit task."""
 # pylint: disable=line-too-long
+import functools
 from typing import Callable, NamedTuple, Tuple, Union, Optional, List
 
+import chex
 import haiku as hk
 import jax
 import jax.numpy as jnp
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 import numpy as np
+from scipy import special
+
+try:
+  import numba
+except ImportError:  # numba is optional; run_experiment falls back to python.
+  numba = None
 
 from . import rnn_utils
 DatasetRNN = rnn_utils.DatasetRNN
@@ -38,6 +46,12 @@ def _check_in_0_1_range(x, name):
         f'Value of {name} must be in [0, 1] range. Found value of {x}.')
 
 
+def _check_sigma(sigma):
+  if sigma < 0:
+    msg = f'Argument sigma must be at least 0. Found: {sigma}.'
+    raise ValueError(msg)
+
+
 ###################################
 # GENERATIVE FUNCTIONS FOR AGENTS #
 ###################################
@@ -86,15 +100,35 @@ class AgentQ:
 
   def get_choice_probs(self) -> np.ndarray:
     """Compute the choice probabilities as softmax over q."""
+    if self._n_actions == 2:
+      # Softmax over two actions reduces to a sigmoid of the difference.
+      decision_difference = self._beta * (self._q[1] - self._q[0])
+      if self._prev_choice is not None:
+        if self._prev_choice == 1:
+          decision_difference += self._perseveration_bias
+        else:
+          decision_difference -= self._perseveration_bias
+      choice_1_prob = special.expit(decision_difference)
+      return np.array([1. - choice_1_prob, choice_1_prob])
     decision_variable = self._beta * self._q
     if self._prev_choice is not None:
       decision_variable[self._prev_choice] += self._perseveration_bias
-    choice_probs = np.exp(decision_variable) / np.sum(np.exp(decision_variable))
+    choice_probs = special.softmax(decision_variable)
     return choice_probs
 
-  def get_choice(self) -> int:
-    """Sample a choice, given the agent's current internal state."""
+  def get_choice(self, uniform: Optional[float] = None) -> int:
+    """Sample a choice, given the agent's current internal state.
+
+    Args:
+      uniform: Optional pre-drawn sample from U[0, 1) to make the choice with.
+        Only used when there are two actions.
+    """
     choice_probs = self.get_choice_probs()
+    if self._n_actions == 2:
+      # A single uniform draw is much cheaper than np.random.choice.
+      if uniform is None:
+        uniform = np.random.random()
+      return int(uniform < choice_probs[1])
     choice = np.random.choice(self._n_actions, p=choice_probs)
     return choice
 
@@ -143,78 +177,125 @@ class AgentNetwork:
                make_network: Callable[[], hk.RNNCore],
                params: hk.Params,
                n_actions: int = 2,
-               state_to_numpy: bool = False):
+               state_to_numpy: bool = False,
+               use_bfloat16: bool = False):
     """Initialize the agent network.
     
     Args: 
       make_network: function that instantiates a callable haiku network object
       params: parameters for the network
       n_actions: number of permitted actions (default = 2)
+      state_to_numpy: whether to convert the network state to numpy after
+        each update (default = False)
+      use_bfloat16: run the network in bfloat16 rather than float32. Faster on
+        accelerators, at a small cost in precision of the output logits
+        (default = False)
     """
     self._state_to_numpy = state_to_numpy
 
-    def _step_network(xs: np.ndarray,
-                      state: hk.State) -> Tuple[np.ndarray, hk.State]:
-      """Apply one step of the network.
-      
-      Args:
-        xs: array containing network inputs
-        state: previous state of the hidden units of the RNN model.
-        
-      Returns:
-        y_hat: output of RNN
-        new_state: state of the hidden units of the RNN model
-      """
+    def _network_fns():
+      """Build the network once, and share it between its two functions."""
       core = make_network()
-      y_hat, new_state = core(xs, state)
-      return y_hat, new_state
 
-    def _get_initial_state() -> hk.State:
-      """Get the initial state of the hidden units of RNN model."""
-      core = make_network()
-      state = core.initial_state(1)
-      return state
+      def _get_initial_state() -> hk.State:
+        """Get the initial state of the hidden units of RNN model."""
+        return core.initial_state(1)
 
-    key = jax.random.PRNGKey(0)
-    model = hk.transform(_step_network)
-    state = hk.transform(_get_initial_state)
+      def _step_network(xs: np.ndarray,
+                        state: hk.State) -> Tuple[np.ndarray, hk.State]:
+        """Apply one step of the network.
+
+        Args:
+          xs: array containing network inputs
+          state: previous state of the hidden units of the RNN model.
 
-    self._initial_state = state.apply(params, key)
-    self._model_fun = jax.jit(
-        lambda xs, state: model.apply(params, key, xs, state))
-    self._xs = np.zeros((1, 2))
+        Returns:
+          y_hat: output of RNN
+          new_state: state of the hidden units of the RNN model
+        """
+        y_hat, new_state = core(xs, state)
+        return y_hat, new_state
+
+      return _get_initial_state, (_get_initial_state, _step_network)
+
+    key = jax.random.PRNGKey(0)
+    model = hk.multi_transform(_network_fns)
+    get_initial_state, step_network = model.apply
+
+    def _to_input_dtype(x):
+      x = jnp.asarray(x)
+      if use_bfloat16 and jnp.issubdtype(x.dtype, jnp.floating):
+        return x.astype(jnp.bfloat16)
+      return x
+
+    def _apply_network(params, xs, state):
+      output_logits, new_state = step_network(
+          params, key, _to_input_dtype(xs), state)
+      # Keep the state's dtypes fixed from one step to the next
+      new_state = jax.tree_util.tree_map(
+          lambda new, old: new.astype(old.dtype), new_state, state)
+      return output_logits, new_state
+
+    @jax.jit
+    def _fused_step(params, state, choice, reward):
+      """Feed the previous choice and reward, return choice probs + new state."""
+      xs = jnp.array([[choice, reward]], dtype=jnp.float32)
+      output_logits, new_state = _apply_network(params, xs, state)
+      choice_logits = output_logits[0, :n_actions].astype(jnp.float32)
+      choice_probs = jax.nn.softmax(choice_logits)
+      return choice_probs, new_state
+
+    # Cast once up front, so every step runs in the chosen precision
+    params = jax.tree_util.tree_map(_to_input_dtype, params)
+    self._params = params
+    self._initial_state = jax.tree_util.tree_map(
+        _to_input_dtype, get_initial_state(params, key))
+    self._apply_network = _apply_network
+    self._step_fun = _fused_step
     self._n_actions = n_actions
     self.new_sess()
 
   def new_sess(self):
     """Reset the network for the beginning of a new session."""
     self._state = self._initial_state
+    # The first input of a session is a choice and reward of 0
+    self._prev_choice = 0
+    self._prev_reward = 0
+    self._choice_probs = None
+    self._next_state = None
+
+  def _step(self):
+    """Run the network once on the previous choice and reward, if not yet done."""
+    if self._choice_probs is None:
+      choice_probs, self._next_state = self._step_fun(
+          self._params, self._state, self._prev_choice, self._prev_reward)
+      self._choice_probs = np.asarray(choice_probs)
 
   def get_choice_probs(self) -> np.ndarray:
     """Predict the choice probabilities as a softmax over output logits."""
-    output_logits, _ = self._model_fun(self._xs, self._state)
-    output_logits = np.array(output_logits)
-    output_logits = output_logits[0][:self._n_actions]
-    choice_probs = np.exp(output_logits) / np.sum(
-        np.exp(output_logits))
-    return choice_probs
+    self._step()
+    return self._choice_probs.copy()
 
   def get_choice(self) -> Tuple[int, np.ndarray]:
     """Sample choice."""
     choice_probs = self.get_choice_probs()
+    if self._n_actions == 2:
+      return int(np.random.random() < choice_probs[1])
     choice = np.random.choice(self._n_actions, p=choice_probs)
     return choice
 
   def update(self, choice: int, reward: int):
-    try:
-      self._xs = np.array([[choice, reward]])
-      _, new_state = self._model_fun(self._xs, self._state)
-      if self._state_to_numpy:
-        self._state = np.array(new_state)
-      else:
-        self._state = new_state
-    except:
-      import pdb; pdb.set_trace()
+    """Advance the network state and store this trial's choice and reward."""
+    self._step()
+    if self._state_to_numpy:
+      self._state = np.array(self._next_state)
+    else:
+      self._state = self._next_state
+    self._prev_choice = choice
+    self._prev_reward = reward
+    self._choice_probs = None
+    self._next_state = None
+
 
 class VanillaAgentQ(AgentQ):
   """This agent is a wrapper of AgentQ with only alpha and beta parameters."""
@@ -241,6 +322,123 @@ class ExtraMysteryAgentQ(AgentQ):
         alpha, beta, n_actions=n_actions, forgetting_rate=mystery_param)
 
 
+# AgentQ and the subclasses that only change its parameters. The compiled fast
+# paths simulate these directly, so they must not be used for other subclasses,
+# which may override how the agent chooses or learns.
+_PLAIN_Q_AGENTS = (AgentQ, VanillaAgentQ, MysteryAgentQ, ExtraMysteryAgentQ)
+
+
+class VectorAgentQ:
+  """Many independent Q-learning agents, run together with vectorized ops.
+
+  Behaves like n_agents copies of AgentQ, but holds their state in arrays with
+  one row per agent, so e.g. a parameter sweep steps every agent at once.
+
+  Attributes:
+    q: The agents' current estimates of the reward probability on each arm,
+      with shape [n_agents, n_actions]
+    n_agents: number of agents
+  """
+
+  def __init__(
+      self,
+      alpha: Union[float, np.ndarray] = 0.2,
+      beta: Union[float, np.ndarray] = 3.,
+      n_actions: int = 2,
+      forgetting_rate: Union[float, np.ndarray] = 0.,
+      perseveration_bias: Union[float, np.ndarray] = 0.,
+      n_agents: Optional[int] = None):
+    """Initialize the agents.
+
+    Each parameter is either a scalar shared by all agents, or an array with
+    one value per agent.
+
+    Args:
+      alpha: learning rate
+      beta: softmax inverse temperature parameter.
+      n_actions: number of actions (default=2)
+      forgetting_rate: rate at which q values decay toward the initial values (default=0)
+      perseveration_bias: rate at which q values move toward previous action (default=0)
+      n_agents: number of agents. If not given, it is inferred from the
+        lengths of the array parameters (1 if all parameters are scalars)
+    """
+    params = [np.atleast_1d(np.asarray(x, dtype=float))
+              for x in (alpha, beta, forgetting_rate, perseveration_bias)]
+    if n_agents is None:
+      params = np.broadcast_arrays(*params)
+    else:
+      try:
+        params = [np.broadcast_to(x, (n_agents,)) for x in params]
+      except ValueError as e:
+        msg = (f'Parameters must be scalars or have length n_agents='
+               f'{n_agents}. Found lengths: {[len(x) for x in params]}.')
+        raise ValueError(msg) from e
+    (self._alpha, self._beta, self._forgetting_rate,
+     self._perseveration_bias) = params
+    self._n_agents = len(self._alpha)
+    self._n_actions = n_actions
+    self._q_init = 0.5
+    self.new_sess()
+
+    for a in self._alpha:
+      _check_in_0_1_range(a, 'alpha')
+    for f in self._forgetting_rate:
+      _check_in_0_1_range(f, 'forgetting_rate')
+
+  def new_sess(self):
+    """Reset the agents for the beginning of a new session."""
+    self._q = self._q_init * np.ones((self._n_agents, self._n_actions))
+    self._prev_choice = None
+
+  def get_choice_probs(self) -> np.ndarray:
+    """Compute the choice probabilities as softmax over q, for each agent."""
+    decision_variable = self._beta[:, None] * self._q
+    if self._prev_choice is not None:
+      decision_variable[np.arange(self._n_agents), self._prev_choice] += (
+          self._perseveration_bias)
+    choice_probs = special.softmax(decision_variable, axis=1)
+    return choice_probs
+
+  def get_choice(self) -> np.ndarray:
+    """Sample a choice for every agent, given their current internal states."""
+    choice_probs = self.get_choice_probs()
+    uniform = np.random.random(self._n_agents)
+    if self._n_actions == 2:
+      return (uniform < choice_probs[:, 1]).astype(np.int8)
+    # Otherwise sample each agent's choice from its cumulative probabilities
+    cumulative_probs = np.cumsum(choice_probs, axis=1)[:, :-1]
+    return np.sum(uniform[:, None] >= cumulative_probs, axis=1).astype(np.int8)
+
+  def update(self,
+             choice: np.ndarray,
+             reward: np.ndarray):
+    """Update the agents after one step of the task.
+
+    Args:
+      choice: The choices made by the agents, shape [n_agents]
+      reward: The rewards received by the agents, shape [n_agents]
+    """
+    # Decay q-values toward the initial value.
+    forgetting_rate = self._forgetting_rate[:, None]
+    self._q = ((1 - forgetting_rate) * self._q +
+               forgetting_rate * self._q_init)
+
+    self._prev_choice = choice
+
+    # Update chosen q for chosen action with observed reward.
+    agents = np.arange(self._n_agents)
+    self._q[agents, choice] = ((1 - self._alpha) * self._q[agents, choice] +
+                               self._alpha * reward)
+
+  @property
+  def q(self):
+    return self._q.copy()
+
+  @property
+  def n_agents(self) -> int:
+    return self._n_agents
+
+
 ################
 # ENVIRONMENTS #
 ################
@@ -313,9 +511,7 @@ class EnvironmentBanditsDrift:
       ):
     """Initialize the environment."""
     # Check inputs
-    if sigma < 0:
-      msg = f'Argument sigma but must be greater than 0. Found: {sigma}.'
-      raise ValueError(msg)
+    _check_sigma(sigma)
 
     # Initialize persistent properties
     self._sigma = sigma
@@ -329,29 +525,53 @@ class EnvironmentBanditsDrift:
     # Sample randomly between 0 and 1
     self._reward_probs = np.random.rand(self._n_actions)
 
-  def step(self, choice: int) -> int:
+  def step(self,
+           choice: int,
+           uniform: Optional[float] = None,
+           normals: Optional[np.ndarray] = None) -> int:
     """Run a single trial of the task.
 
     Args:
       choice: integer specifying choice made by the agent (must be less than
         n_actions.)
+      uniform: Optional pre-drawn sample from U[0, 1) used to sample the reward
+      normals: Optional pre-drawn standard normal samples, one per action, used
+        to drift the reward probabilities
 
     Returns:
       reward: The reward to be given to the agent. 0 or 1.
 
     """
     # Check inputs
-    if choice not in range(self._n_actions):
+    valid_choices = (0, 1) if self._n_actions == 2 else range(self._n_actions)
+    if choice not in valid_choices:
       msg = (
           f'Found value for choice of {choice}, but must be in '
           f'{list(range(self._n_actions))}')
       raise ValueError(msg)
 
     # Sample reward with the probability of the chosen side
-    reward = np.random.rand() < self._reward_probs[choice]
+    if uniform is None:
+      uniform = np.random.rand()
+    reward = uniform < self._reward_probs[choice]
+
+    if self._n_actions == 2:
+      # Same as below, but with scalars to avoid small array allocations
+      if normals is None:
+        drift_0 = self._sigma * np.random.normal()
+        drift_1 = self._sigma * np.random.normal()
+      else:
+        drift_0 = self._sigma * normals[0]
+        drift_1 = self._sigma * normals[1]
+      reward_probs = self._reward_probs
+      reward_probs[0] = min(1., max(0., reward_probs[0] + drift_0))
+      reward_probs[1] = min(1., max(0., reward_probs[1] + drift_1))
+      return reward
 
     # Add gaussian noise to reward probabilities
-    drift = np.random.normal(loc=0, scale=self._sigma, size=self._n_actions)
+    if normals is None:
+      normals = np.random.normal(size=self._n_actions)
+    drift = self._sigma * normals
     self._reward_probs += drift
 
     # Fix reward probs that've drifted below 0 or above 1
@@ -368,22 +588,263 @@ class EnvironmentBanditsDrift:
     return self._n_actions
 
 
+class VectorEnvironmentBanditsDrift:
+  """Many independent drifting bandit tasks, stepped together.
+
+  Behaves like n_envs copies of EnvironmentBanditsDrift, but holds their reward
+  probabilities in one array with a row per environment, so that a
+  VectorAgentQ can play one environment per agent.
+
+  As with EnvironmentBanditsDrift, reward probabilities carry over from one
+  session to the next: run_vector_experiment does not reset them. Call
+  new_sess to sample fresh reward probabilities for every environment.
+
+  Attributes:
+    sigma: A float, between 0 and 1, giving the magnitude of the drift
+    reward_probs: Probability of reward associated with each action, with shape
+      [n_envs, n_actions]
+    n_actions: number of actions available
+    n_envs: number of environments
+  """
+
+  def __init__(
+      self,
+      sigma: float,
+      n_envs: int,
+      n_actions: int = 2,
+      ):
+    """Initialize the environments."""
+    # Check inputs
+    _check_sigma(sigma)
+
+    # Initialize persistent properties
+    self._sigma = sigma
+    self._n_envs = n_envs
+    self._n_actions = n_actions
+
+    # Sample new reward probabilities
+    self._new_sess()
+
+  def new_sess(self):
+    """Reset the environments for the beginning of a new session."""
+    self._new_sess()
+
+  def _new_sess(self):
+    # Pick new reward probabilities.
+    # Sample randomly between 0 and 1
+    self._reward_probs = np.random.rand(self._n_envs, self._n_actions)
+
+  def step(self, choice: np.ndarray) -> np.ndarray:
+    """Run a single trial of the task in every environment.
+
+    Args:
+      choice: integer array with shape [n_envs], giving the choice made in each
+        environment (each must be less than n_actions.)
+
+    Returns:
+      reward: int8 array with shape [n_envs]. 1 if each choice was rewarded,
+        0 otherwise.
+    """
+    choice = np.asarray(choice)
+    if (choice.shape != (self._n_envs,) or
+        not np.issubdtype(choice.dtype, np.integer) or
+        np.any((choice < 0) | (choice >= self._n_actions))):
+      msg = (f'Choice must be an integer array of shape ({self._n_envs},) with '
+             f'values in range(n_actions={self._n_actions}). Found: {choice}.')
+      raise ValueError(msg)
+
+    # Sample rewards
+    reward_probs = self._reward_probs[np.arange(self._n_envs), choice]
+    reward = (np.random.random(self._n_envs) < reward_probs).astype(np.int8)
+    # Add gaussian drift to reward probabilities and keep them between 0 and 1
+    drift = np.random.normal(
+        scale=self._sigma, size=(self._n_envs, self._n_actions))
+    self._reward_probs = np.clip(self._reward_probs + drift, 0, 1)
+
+    return reward
+
+  @property
+  def reward_probs(self) -> np.ndarray:
+    return self._reward_probs.copy()
+
+  @property
+  def n_actions(self) -> int:
+    return self._n_actions
+
+  @property
+  def n_envs(self) -> int:
+    return self._n_envs
+
+
 class BanditSession(NamedTuple):
-  """Holds data for a single session of a bandit task."""
+  """Holds data for a single session of a bandit task.
+
+  Attributes:
+    choices: int8 array of shape [n_trials] with the choice on each trial
+    rewards: int8 array of shape [n_trials] with the reward on each trial
+    timeseries: float32 array of shape [n_trials, n_actions], e.g. the reward
+      probabilities of each arm
+    n_trials: number of trials in the session
+  """
   choices: np.ndarray
   rewards: np.ndarray
   timeseries: np.ndarray
   n_trials: int
 
+  @property
+  def xs(self) -> np.ndarray:
+    """float32 array of shape [n_trials, 2] with [choice, reward] on each trial."""
+    xs = np.empty((len(self.choices), 2), dtype=np.float32)
+    xs[:, 0] = self.choices
+    xs[:, 1] = self.rewards
+    return xs
+
 Agent = Union[AgentQ, AgentNetwork]
 Environment = Union[EnvironmentBanditsFlips, EnvironmentBanditsDrift]
 
 
+def _is_plain_q_on_drift(agent, environment) -> bool:
+  """Whether agent is a plain AgentQ and environment a plain drifting bandit."""
+  return (type(agent) in _PLAIN_Q_AGENTS and  # pylint: disable=unidiomatic-typecheck
+          type(environment) is EnvironmentBanditsDrift)  # pylint: disable=unidiomatic-typecheck
+
+
+def _run_q_drift_trials(alpha, beta, sigma, forgetting_rate,
+                        perseveration_bias, q0, q1, prev_choice, p0, p1,
+                        n_trials, seed):
+  """Scalar trial loop for a two-armed AgentQ on EnvironmentBanditsDrift.
+
+  Compiled with numba when it is installed. prev_choice is -1 before the first
+  choice of a session.
+  """
+  np.random.seed(seed)
+  q_init = 0.5
+  choices = np.empty(n_trials, dtype=np.int8)
+  rewards = np.empty(n_trials, dtype=np.int8)
+  reward_probs = np.empty((n_trials, 2), dtype=np.float32)
+
+  for trial in range(n_trials):
+    reward_probs[trial, 0] = p0
+    reward_probs[trial, 1] = p1
+    # Agent makes a choice
+    decision_difference = beta * (q1 - q0)
+    if prev_choice == 1:
+      decision_difference += perseveration_bias
+    elif prev_choice == 0:
+      decision_difference -= perseveration_bias
+    choice = 1 if np.random.random() < 1. / (1. + np.exp(-decision_difference)) else 0
+    # Environment computes a reward, then drifts
+    reward = 1 if np.random.random() < (p1 if choice == 1 else p0) else 0
+    p0 = min(max(p0 + sigma * np.random.normal(), 0.), 1.)
+    p1 = min(max(p1 + sigma * np.random.normal(), 0.), 1.)
+    # Agent learns
+    q0 = (1 - forgetting_rate) * q0 + forgetting_rate * q_init
+    q1 = (1 - forgetting_rate) * q1 + forgetting_rate * q_init
+    if choice == 1:
+      q1 = (1 - alpha) * q1 + alpha * reward
+    else:
+      q0 = (1 - alpha) * q0 + alpha * reward
+    prev_choice = choice
+    choices[trial] = choice
+    rewards[trial] = reward
+
+  return choices, rewards, reward_probs, q0, q1, prev_choice, p0, p1
+
+
+if numba is not None:
+  _run_q_drift_trials = numba.njit(cache=True)(_run_q_drift_trials)
+
+
+def _run_experiment_q_drift(agent: AgentQ,
+                            environment: EnvironmentBanditsDrift,
+                            n_trials: int) -> BanditSession:
+  """Fast path of run_experiment for a two-armed AgentQ on a drifting bandit.
+
+  Agent and environment state are read from and written back to the objects,
+  so this behaves like the generic loop in run_experiment.
+  """
+  # pylint: disable=protected-access
+  prev_choice = -1 if agent._prev_choice is None else int(agent._prev_choice)
+  (choices, rewards, reward_probs,
+   q0, q1, prev_choice, p0, p1) = _run_q_drift_trials(
+       float(agent._alpha), float(agent._beta), float(environment._sigma),
+       float(agent._forgetting_rate), float(agent._perseveration_bias),
+       float(agent._q[0]), float(agent._q[1]), prev_choice,
+       float(environment._reward_probs[0]),
+       float(environment._reward_probs[1]),
+       n_trials, np.random.randint(2**31))
+  agent._q = np.array([q0, q1])
+  agent._prev_choice = None if prev_choice < 0 else prev_choice
+  environment._reward_probs = np.array([p0, p1])
+  # pylint: enable=protected-access
+
+  experiment = BanditSession(n_trials=n_trials,
+                             choices=choices,
+                             rewards=rewards,
+                             timeseries=reward_probs)
+  return experiment
+
+
+def run_vector_experiment(agent: VectorAgentQ,
+                          environment: VectorEnvironmentBanditsDrift,
+                          n_trials: int) -> List[BanditSession]:
+  """Runs one behavioral session per agent, stepping all agents together.
+
+  Useful e.g. for a parameter sweep. Like run_experiment, this does not reset
+  the agents or environments, so call their new_sess methods to start fresh.
+
+  Args:
+    agent: A VectorAgentQ
+    environment: A VectorEnvironmentBanditsDrift with one environment per agent
+    n_trials: The number of steps in each session you'd like to generate
+
+  Returns:
+    experiments: A list with one BanditSession per agent
+  """
+  if not isinstance(environment, VectorEnvironmentBanditsDrift):
+    msg = ('Environment must be a VectorEnvironmentBanditsDrift. Found: '
+           f'{type(environment).__name__}.')
+    raise ValueError(msg)
+  if environment.n_envs != agent.n_agents:
+    msg = (f'Environment must have one env per agent. Found n_envs='
+           f'{environment.n_envs}, n_agents={agent.n_agents}.')
+    raise ValueError(msg)
+
+  n_agents = agent.n_agents
+  choices = np.empty((n_agents, n_trials), dtype=np.int8)
+  rewards = np.empty((n_agents, n_trials), dtype=np.int8)
+  reward_probs = np.empty((n_agents, n_trials, environment.n_actions),
+                          dtype=np.float32)
+
+  for trial in range(n_trials):
+    # First record environment reward probs
+    reward_probs[:, trial] = environment.reward_probs
+    # First agents make their choices
+    choice = agent.get_choice()
+    # Then environments compute rewards
+    reward = environment.step(choice)
+    # Finally agents learn
+    agent.update(choice, reward)
+    # Log choices and rewards
+    choices[:, trial] = choice
+    rewards[:, trial] = reward
+
+  return [BanditSession(n_trials=n_trials,
+                        choices=choices[i],
+                        rewards=rewards[i],
+                        timeseries=reward_probs[i]) for i in range(n_agents)]
+
+
 def run_experiment(agent: Agent,
                    environment: Environment,
                    n_trials: int) -> BanditSession:
   """Runs a behavioral session from a given agent and environment.
 
+  A two-armed AgentQ on an EnvironmentBanditsDrift runs in a compiled loop when
+  numba is installed (pip install CogModelingRNNsTutorial[fast]). Without
+  numba, it falls back to a python loop that draws all of the session's random
+  numbers up front.
+
   Args:
     agent: An agent object
     environment: An environment object
@@ -392,17 +853,39 @@ def run_experiment(agent: Agent,
   Returns:
     experiment: A BanditSession holding choices and rewards from the session
   """
-  choices = np.zeros(n_trials)
-  rewards = np.zeros(n_trials)
-  reward_probs = np.zeros((n_trials, environment.n_actions))
-
-  for trial in np.arange(n_trials):
+  if isinstance(agent, VectorAgentQ) or isinstance(
+      environment, VectorEnvironmentBanditsDrift):
+    raise ValueError('Use run_vector_experiment to run a VectorAgentQ on a '
+                     'VectorEnvironmentBanditsDrift.')
+
+  is_q_on_drift = (
+      _is_plain_q_on_drift(agent, environment) and
+      agent._n_actions == environment.n_actions == 2)  # pylint: disable=protected-access
+  if is_q_on_drift and numba is not None:
+    return _run_experiment_q_drift(agent, environment, n_trials)
+
+  choices = np.empty(n_trials, dtype=np.int8)
+  rewards = np.empty(n_trials, dtype=np.int8)
+  reward_probs = np.empty((n_trials, environment.n_actions), dtype=np.float32)
+
+  if is_q_on_drift:
+    # numba is not installed. Draw all random numbers for the session up front,
+    # rather than with several separate calls on every trial
+    uniforms = np.random.random((n_trials, 2))
+    normals = np.random.normal(size=(n_trials, 2))
+
+  for trial in range(n_trials):
     # First record environment reward probs
     reward_probs[trial] = environment.reward_probs
-    # First agent makes a choice
-    choice = agent.get_choice()
-    # Then environment computes a reward
-    reward = environment.step(choice)
+    if is_q_on_drift:
+      choice = agent.get_choice(uniform=uniforms[trial, 0])
+      reward = environment.step(
+          choice, uniform=uniforms[trial, 1], normals=normals[trial])
+    else:
+      # First agent makes a choice
+      choice = agent.get_choice()
+      # Then environment computes a reward
+      reward = environment.step(choice)
     # Finally agent learns
     agent.update(choice, reward)
     # Log choice and reward
@@ -416,6 +899,181 @@ def run_experiment(agent: Agent,
   return experiment
 
 
+def _drift_env_step(reward_key, drift_key, reward_probs, choice, sigma):
+  """Pure-jax version of EnvironmentBanditsDrift.step."""
+  reward = jax.random.bernoulli(reward_key, reward_probs[choice])
+  drift = sigma * jax.random.normal(drift_key, reward_probs.shape)
+  new_reward_probs = jnp.clip(reward_probs + drift, 0, 1)
+  return reward, new_reward_probs
+
+
+def _rollout_q_drift(
+    random_key: chex.PRNGKey,
+    alpha: float,
+    beta: float,
+    sigma: float,
+    forgetting_rate: float,
+    perseveration_bias: float,
+    n_trials: int,
+    n_actions: int,
+) -> Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+  """Run one session of AgentQ on EnvironmentBanditsDrift as a lax.scan."""
+  q_init = 0.5
+  init_key, random_key = jax.random.split(random_key)
+  q = q_init * jnp.ones(n_actions)
+  prev_choice = jnp.zeros(n_actions)  # One-hot; all zeros before first choice
+  reward_probs = jax.random.uniform(init_key, (n_actions,))
+
+  def q_step(carry, key):
+    q, prev_choice, reward_probs = carry
+    choice_key, reward_key, drift_key = jax.random.split(key, 3)
+    # First agent makes a choice
+    decision_variable = beta * q + perseveration_bias * prev_choice
+    choice = jax.random.categorical(choice_key, decision_variable)
+    # Then environment computes a reward and drifts its reward probabilities
+    reward, new_reward_probs = _drift_env_step(
+        reward_key, drift_key, reward_probs, choice, sigma)
+    # Finally agent learns
+    q = (1 - forgetting_rate) * q + forgetting_rate * q_init
+    q = q.at[choice].set((1 - alpha) * q[choice] + alpha * reward)
+    new_carry = (q, jax.nn.one_hot(choice, n_actions), new_reward_probs)
+    return new_carry, (choice, reward, reward_probs)
+
+  _, (choices, rewards, reward_probs) = jax.lax.scan(
+      q_step, (q, prev_choice, reward_probs),
+      jax.random.split(random_key, n_trials))
+  return choices, rewards, reward_probs
+
+
+@functools.partial(jax.jit, static_argnames=('n_trials', 'n_actions'))
+def _rollout_q_drift_sessions(random_keys, alpha, beta, sigma, forgetting_rate,
+                              perseveration_bias, n_trials, n_actions):
+  rollout = functools.partial(
+      _rollout_q_drift, n_trials=n_trials, n_actions=n_actions)
+  return jax.vmap(rollout, in_axes=(0, None, None, None, None, None))(
+      random_keys, alpha, beta, sigma, forgetting_rate, perseveration_bias)
+
+
+def _rollout_network_drift(
+    random_key: chex.PRNGKey,
+    params: hk.Params,
+    initial_state: hk.State,
+    sigma: float,
+    apply_network: Callable[[hk.Params, jnp.ndarray, hk.State],
+                            Tuple[jnp.ndarray, hk.State]],
+    n_trials: int,
+    n_actions: int,
+) -> Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+  """Run one session of an AgentNetwork on EnvironmentBanditsDrift as a lax.scan."""
+  init_key, random_key = jax.random.split(random_key)
+  xs = jnp.zeros((1, 2), dtype=jnp.float32)  # First input is choice, reward = 0
+  reward_probs = jax.random.uniform(init_key, (n_actions,))
+
+  def network_step(carry, key):
+    state, xs, reward_probs = carry
+    choice_key, reward_key, drift_key = jax.random.split(key, 3)
+    # First network makes a choice
+    output_logits, new_state = apply_network(params, xs, state)
+    choice_logits = output_logits[0, :n_actions].astype(jnp.float32)
+    choice = jax.random.categorical(choice_key, choice_logits)
+    # Then environment computes a reward and drifts its reward probabilities
+    reward, new_reward_probs = _drift_env_step(
+        reward_key, drift_key, reward_probs, choice, sigma)
+    # Next input to the network is this trial's choice and reward
+    new_xs = jnp.array([[choice, reward]], dtype=jnp.float32)
+    new_carry = (new_state, new_xs, new_reward_probs)
+    return new_carry, (choice, reward, reward_probs)
+
+  _, (choices, rewards, reward_probs) = jax.lax.scan(
+      network_step, (initial_state, xs, reward_probs),
+      jax.random.split(random_key, n_trials))
+  return choices, rewards, reward_probs
+
+
+@functools.partial(
+    jax.jit, static_argnames=('apply_network', 'n_trials', 'n_actions'))
+def _rollout_network_drift_sessions(random_keys, params, initial_state, sigma,
+                                    apply_network, n_trials, n_actions):
+  rollout = functools.partial(
+      _rollout_network_drift, apply_network=apply_network, n_trials=n_trials,
+      n_actions=n_actions)
+  return jax.vmap(rollout, in_axes=(0, None, None, None))(
+      random_keys, params, initial_state, sigma)
+
+
+def run_experiments_batched(
+    agent: Union[AgentQ, AgentNetwork],
+    environment: EnvironmentBanditsDrift,
+    n_trials: int,
+    n_sessions: int,
+    random_key: Optional[chex.PRNGKey] = None,
+) -> List[BanditSession]:
+  """Runs many sessions of an agent on a drifting bandit in parallel.
+
+  The whole agent + environment loop is compiled with jax, and sessions are run
+  in parallel with vmap. Every session starts from a fresh agent (initial
+  q-values or network state) and fresh, randomly drawn reward probabilities;
+  the agent and environment objects are only used for their parameters.
+
+  Args:
+    agent: An AgentQ (or a parameter-only subclass: VanillaAgentQ, MysteryAgentQ,
+      ExtraMysteryAgentQ) or AgentNetwork object
+    environment: An EnvironmentBanditsDrift object
+    n_trials: The number of steps in each session
+    n_sessions: The number of sessions to generate
+    random_key: A jax random key. If not specified, one is drawn from numpy.
+
+  Returns:
+    experiment_list: A list of BanditSessions, one per session
+  """
+  # Exact types only: subclasses may change behavior the rollouts don't know of
+  if not (type(agent) in _PLAIN_Q_AGENTS or type(agent) is AgentNetwork):  # pylint: disable=unidiomatic-typecheck
+    raise ValueError(
+        f'agent must be an AgentQ or AgentNetwork. Found: {type(agent)}.')
+  if type(environment) is not EnvironmentBanditsDrift:  # pylint: disable=unidiomatic-typecheck
+    raise ValueError(
+        f'environment must be an EnvironmentBanditsDrift. Found: {type(environment)}.')
+  if agent._n_actions != environment.n_actions:  # pylint: disable=protected-access
+    raise ValueError('agent and environment must have the same n_actions.')
+
+  if random_key is None:
+    random_key = jax.random.PRNGKey(np.random.randint(2**32))
+
+  # pylint: disable=protected-access
+  random_keys = jax.random.split(random_key, n_sessions)
+  if isinstance(agent, AgentQ):
+    choices, rewards, reward_probs = _rollout_q_drift_sessions(
+        random_keys,
+        agent._alpha,
+        agent._beta,
+        environment._sigma,
+        agent._forgetting_rate,
+        agent._perseveration_bias,
+        n_trials=n_trials,
+        n_actions=environment.n_actions)
+  else:
+    choices, rewards, reward_probs = _rollout_network_drift_sessions(
+        random_keys,
+        agent._params,
+        agent._initial_state,
+        environment._sigma,
+        apply_network=agent._apply_network,
+        n_trials=n_trials,
+        n_actions=environment.n_actions)
+  # pylint: enable=protected-access
+  choices = np.asarray(choices).astype(np.int8)
+  rewards = np.asarray(rewards).astype(np.int8)
+  reward_probs = np.asarray(reward_probs).astype(np.float32, copy=False)
+
+  experiment_list = [
+      BanditSession(n_trials=n_trials,
+                    choices=choices[sess_i],
+                    rewards=rewards[sess_i],
+                    timeseries=reward_probs[sess_i])
+      for sess_i in range(n_sessions)]
+  return experiment_list
+
+
 def plot_session(choices: np.ndarray,
                  rewards: np.ndarray,
                  timeseries: np.ndarray,
@@ -508,18 +1166,16 @@ def create_dataset(agent: Agent,
     A DatasetRNN object suitable for training RNNs.
     An experliment_list with the results of (simulated) experiments
   """
-  xs = np.zeros((n_trials_per_session, n_sessions, 2))
-  ys = np.zeros((n_trials_per_session, n_sessions, 1))
+  xs = np.zeros((n_trials_per_session, n_sessions, 2), dtype=np.float32)
+  ys = np.zeros((n_trials_per_session, n_sessions, 1), dtype=np.float32)
   experiment_list = []
 
   for sess_i in np.arange(n_sessions):
     experiment = run_experiment(agent, environment, n_trials_per_session)
     experiment_list.append(experiment)
-    prev_choices = np.concatenate(([0], experiment.choices[0:-1]))
-    prev_rewards = np.concatenate(([0], experiment.rewards[0:-1]))
-    xs[:, sess_i] = np.swapaxes(
-        np.concatenate(([prev_choices], [prev_rewards]), axis=0), 0, 1)
-    ys[:, sess_i] = np.expand_dims(experiment.choices, 1)
+    # Inputs are the previous trial's choice and reward (zeros on first trial)
+    xs[1:, sess_i] = experiment.xs[:-1]
+    ys[:, sess_i, 0] = experiment.choices
 
   dataset = DatasetRNN(xs, ys, batch_size)
   return dataset, experiment_list
@@ -1,6 +1,7 @@
 """Utility functions for training RNNs."""
 from __future__ import print_function
 
+import functools
 from typing import Any, Callable, Dict, Optional, Tuple
 
 import chex
@@ -72,13 +73,54 @@ class DatasetRNN():
       raise ValueError(msg.format(xs.shape[1], batch_size))
 
     # Property setting
-    self._xs = xs
-    self._ys = ys
     self._batch_size = batch_size
-    self._dataset_size = self._xs.shape[1]
+    self._dataset_size = xs.shape[1]
     self._idx = 0
     self.n_batches = self._dataset_size // self._batch_size
 
+    # Store each batch as a contiguous [timestep, episode, feature] slab,
+    # stacked as [batch, timestep, episode, feature]
+    self._xs_batched = self._split_into_batches(xs)
+    self._ys_batched = self._split_into_batches(ys)
+
+  def _split_into_batches(self, data: np.ndarray) -> np.ndarray:
+    batched = data.reshape(
+        data.shape[0], self.n_batches, self._batch_size, data.shape[2])
+    return np.ascontiguousarray(batched.transpose(1, 0, 2, 3))
+
+  def _merge_batches(self, batched: np.ndarray) -> np.ndarray:
+    data = batched.transpose(1, 0, 2, 3)
+    return data.reshape(data.shape[0], self._dataset_size, data.shape[3])
+
+  @property
+  def _xs(self) -> np.ndarray:
+    """All inputs, as [timestep, episode, feature]."""
+    return self._merge_batches(self._xs_batched)
+
+  @property
+  def _ys(self) -> np.ndarray:
+    """All targets, as [timestep, episode, feature]."""
+    return self._merge_batches(self._ys_batched)
+
+  @property
+  def xs_batched(self) -> np.ndarray:
+    """All inputs, as [batch, timestep, episode, feature]."""
+    return self._xs_batched
+
+  @property
+  def ys_batched(self) -> np.ndarray:
+    """All targets, as [batch, timestep, episode, feature]."""
+    return self._ys_batched
+
+  @property
+  def position(self) -> int:
+    """Index of the batch that the next call to next() will serve."""
+    return self._idx
+
+  def advance(self, n: int):
+    """Skip ahead n batches, as if next() had been called n times."""
+    self._idx = (self._idx + n) % self.n_batches
+
   def __iter__(self):
     return self
 
@@ -89,30 +131,19 @@ class DatasetRNN():
       x, y: next input (x) and target (y) in sequence.
     """
 
-    # Define the chunk we want: from idx to idx + batch_size
-    start = self._idx
-    end = start + self._batch_size
-    # Check that we're not trying to overshoot the size of the dataset
-    assert end <= self._dataset_size
-
-    # Update the index for next time
-    if end == self._dataset_size:
-      self._idx = 0
-    else:
-      self._idx = end
+    # Get the batch we want, and update the index for next time
+    batch_i = self._idx
+    self._idx = (batch_i + 1) % self.n_batches
 
     # Get the chunks of data
-    x, y = self._xs[:, start:end], self._ys[:, start:end]
+    x, y = self._xs_batched[batch_i], self._ys_batched[batch_i]
 
     return x, y
 
 
 def nan_in_dict(d):
-  """Check a nested dict (e.g. hk.params) for nans."""
-  if not isinstance(d, dict):
-    return np.any(np.isnan(d))
-  else:
-    return any(nan_in_dict(v) for v in d.values())
+  """Check a nested dict (e.g. hk.params) for nans, stopping at the first."""
+  return any(bool(jnp.isnan(x).any()) for x in jax.tree_util.tree_leaves(d))
 
 
 def train_model(
@@ -127,6 +158,7 @@ def train_model(
     loss_fun: str = 'categorical',
     do_plot: bool = True,
     truncate_seq_length: Optional[int] = None,
+    remat: bool = False,
     ) -> Tuple[hk.Params, optax.OptState, Dict[str, np.ndarray]]:
   """Trains a model for a fixed number of steps.
 
@@ -146,6 +178,9 @@ def train_model(
     do_plot: Boolean that controls whether a learning curve is plotted
       (default=True)
     truncate_seq_length: truncate to sequence length (default=None)
+    remat: Boolean that controls whether each step's activations are recomputed
+      on the backward pass rather than stored. Saves memory on long sequences
+      at the cost of extra compute (default=False)
 
   Returns:
     params: Trained parameters
@@ -153,14 +188,27 @@ def train_model(
     losses: Losses on both datasets
   """
   n_steps = int(n_steps)
-  sample_xs, _ = next(dataset)  # Get a sample input, for shape
+  sample_xs, sample_ys = next(dataset)  # Get a sample input, for shape
+  if sample_ys.shape[2] != 1:
+    raise ValueError(
+        'Categorical loss function requires targets to be of dimensionality'
+        ' (n_timesteps, n_episodes, 1)'
+    )
 
   # Haiku, step one: Define the batched network
   def unroll_network(xs):
     core = model_fun()
     batch_size = jnp.shape(xs)[1]
     state = core.initial_state(batch_size)
-    ys, _ = hk.dynamic_unroll(core, xs, state)
+    # Optionally recompute each step's activations on the backward pass rather
+    # than storing them all, which keeps memory down for long sessions
+    step_core = hk.remat(core) if remat else core
+
+    def scan_step(state, xs_t):
+      y_t, new_state = step_core(xs_t, state)
+      return new_state, y_t
+
+    _, ys = hk.scan(scan_step, state, xs)
     return ys
 
   # Haiku, step two: Transform the network into a pair of functions
@@ -181,20 +229,14 @@ def train_model(
   def categorical_log_likelihood(
       labels: np.ndarray, output_logits: np.ndarray
   ) -> float:
-    # Mask any errors for which label is negative
-    mask = jnp.logical_not(labels < 0)
+    # Mask any errors for which label is negative (or has no output logit)
+    num_classes = output_logits.shape[-1]
+    mask = jnp.logical_and(labels >= 0, labels < num_classes)
     log_probs = jax.nn.log_softmax(output_logits)
-    if labels.shape[2] != 1:
-      raise ValueError(
-          'Categorical loss function requires targets to be of dimensionality'
-          ' (n_timesteps, n_episodes, 1)'
-      )
-    one_hot_labels = jax.nn.one_hot(
-        labels[:, :, 0], num_classes=output_logits.shape[-1]
-    )
-    log_liks = one_hot_labels * log_probs
-    masked_log_liks = jnp.multiply(log_liks, mask)
-    loss = -jnp.nansum(masked_log_liks)
+    # Pick out the log prob of each label (masked labels just index class 0)
+    label_idx = jnp.where(mask, labels, 0).astype(jnp.int32)
+    log_liks = jnp.take_along_axis(log_probs, label_idx, axis=-1)
+    loss = -jnp.where(mask, log_liks, 0).sum()
     return loss
 
   def categorical_loss(
@@ -223,38 +265,88 @@ def train_model(
       'penalized_categorical': penalized_categorical_loss,
   }
   compute_loss = jax.jit(losses[loss_fun])
+  grad_fn = jax.value_and_grad(compute_loss, argnums=0)
 
   # Define what it means to train a single step
-  @jax.jit
   def train_step(
       params, opt_state, xs, ys, random_key
   ) -> Tuple[float, Any, Any]:
-    loss, grads = jax.value_and_grad(compute_loss, argnums=0)(
-        params, xs, ys, random_key
-    )
-    grads, opt_state = optimizer.update(grads, opt_state)
-    params = optax.apply_updates(params, grads)
+    loss, grads = grad_fn(params, xs, ys, random_key)
+    updates, opt_state = optimizer.update(grads, opt_state)
+    params = optax.apply_updates(params, updates)
     return loss, params, opt_state
 
+  # Train a chunk of steps in one compiled call, scanning over batch indices
+  # and keys. Steps that are not active (padding at the end of training) leave
+  # params and opt_state unchanged. params and opt_state are donated, so XLA
+  # can update them in place.
+  @functools.partial(jax.jit, donate_argnums=(0, 1))
+  def train_steps(
+      params, opt_state, xs_batched, ys_batched, batch_idxs, random_keys, active
+  ) -> Tuple[Any, Any, jnp.ndarray]:
+    def scan_step(carry, inputs):
+      batch_i, random_key, step_active = inputs
+
+      def do_step(carry):
+        loss, params, opt_state = train_step(
+            *carry, xs_batched[batch_i], ys_batched[batch_i], random_key)
+        return (params, opt_state), loss.astype(jnp.float32)
+
+      def skip_step(carry):
+        return carry, jnp.array(jnp.nan, dtype=jnp.float32)
+
+      return jax.lax.cond(step_active, do_step, skip_step, carry)
+
+    (params, opt_state), losses = jax.lax.scan(
+        scan_step, (params, opt_state), (batch_idxs, random_keys, active))
+    return params, opt_state, losses
+
+  # Copy params and opt_state, so that donating them to train_steps does not
+  # invalidate the caller's arrays
+  params, opt_state = jax.tree_util.tree_map(jnp.array, (params, opt_state))
+
+  # Put the (truncated) training data on the device once, as
+  # [batch, timestep, episode, feature]
+  xs_batched = dataset.xs_batched
+  ys_batched = dataset.ys_batched
+  if (truncate_seq_length is not None) and (truncate_seq_length < xs_batched.shape[1]):
+    xs_batched = xs_batched[:, :truncate_seq_length]
+    ys_batched = ys_batched[:, :truncate_seq_length]
+  xs_batched, ys_batched = jax.device_put((xs_batched, ys_batched))
+
+  # Every chunk has the same length, so train_steps only compiles once. The
+  # last chunk is padded with inactive steps.
+  steps_per_chunk = max(1, min(100, n_steps))
+  n_chunks = -(-n_steps // steps_per_chunk)  # Round up
+  n_padded_steps = n_chunks * steps_per_chunk
+  # Step through the dataset's batches in order, from wherever it is now
+  first_batch = dataset.position
+  batch_idxs = (first_batch + np.arange(n_padded_steps)) % dataset.n_batches
+  active = np.arange(n_padded_steps) < n_steps
+  # Split all the keys we need at once, rather than once per step
+  keys = jax.random.split(random_key, n_padded_steps)
+
   # Train the network!
   training_loss = []
   t_start = time.time()
-  for step in jnp.arange(n_steps):
-    random_key, key_i = jax.random.split(random_key, 2)
-    # Train on training data
-    xs, ys = next(dataset)
-    if (truncate_seq_length is not None) and (truncate_seq_length < xs.shape[0]):
-      xs = xs[:truncate_seq_length]
-      ys = ys[:truncate_seq_length]
-
-    loss, params, opt_state = train_step(params, opt_state, xs, ys, key_i)
+  for chunk_start in range(0, n_padded_steps, steps_per_chunk):
+    chunk = slice(chunk_start, chunk_start + steps_per_chunk)
+    params, opt_state, losses = train_steps(
+        params, opt_state, xs_batched, ys_batched,
+        batch_idxs[chunk], keys[chunk], active[chunk])
+    # Bring the losses back to the host once per chunk
+    chunk_end = min(chunk_start + steps_per_chunk, n_steps)
+    losses = np.asarray(losses)[:chunk_end - chunk_start]
 
     # Log every 10th step
-    if step % 10 == 9:
-      training_loss.append(float(loss))
-      print((f'\rStep {step + 1} of {n_steps}; '
-             f'Loss: {loss:.4e}. '
-             f'(Time: {time.time()-t_start:.1f}s)'), end='')
+    steps = np.arange(chunk_start, chunk_end)
+    training_loss.extend(losses[steps % 10 == 9].tolist())
+    print((f'\rStep {chunk_end} of {n_steps}; '
+           f'Loss: {losses[-1]:.4e}. '
+           f'(Time: {time.time()-t_start:.1f}s)'), end='')
+
+  # Leave the dataset where it would be after serving one batch per step
+  dataset.advance(n_steps)
 
   # If we actually did any training, print final loss and make a nice plot
   if n_steps > 1 and do_plot: